@@ -1,18 +1,87 @@
 import json
-import pydot
-from os.path import isfile, join
+import pickle
+import sys
+from cmake_graph import dot
+from os import getpid, makedirs, replace, stat
+from os.path import dirname, join
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# more targets than this are drawn as a simplified graph
+SIMPLE_THRESHOLD_DEFAULT = 300
+
 Dependence = namedtuple("Dependence", "source to graph full_dep")
 
 
+def load_json(json_fpath):
+    # open() raises FileNotFoundError with the path,
+    # no need for an extra stat per file
+    if orjson is not None:
+        with open(json_fpath, "rb") as f:
+            return orjson.loads(f.read())
+
+    with open(json_fpath, "r") as f:
+        return json.load(f)
+
+
+class ReplyCache:
+    """
+    The parsed reply files, pickled between the runs.
+
+    A file is looked up by its path, modification time and size,
+    so the files rewritten by CMake are parsed again.
+    Only the files read in this run are saved back.
+    """
+
+    def __init__(self, cache_fpath):
+        self._cache_fpath = cache_fpath
+        self._cached = {}
+        self._used = {}
+        try:
+            with open(cache_fpath, "rb") as f:
+                self._cached = pickle.load(f)
+        except Exception as e:
+            # a missing, truncated or stale pickle only means a cold cache
+            logging.debug(f"not using the reply cache {cache_fpath}: {e}")
+
+    def load_json(self, json_fpath):
+        st = stat(json_fpath)
+        key = (json_fpath, st.st_mtime_ns, st.st_size)
+        json_data = self._cached.get(key)
+        if json_data is None:
+            json_data = load_json(json_fpath)
+        self._used[key] = json_data
+        return json_data
+
+    def save(self):
+        if self._used.keys() == self._cached.keys():
+            return
+
+        # write to a temporary file and move it in place,
+        # a concurrent run never sees a half-written cache
+        tmp_fpath = f"{self._cache_fpath}.{getpid()}.tmp"
+        try:
+            makedirs(dirname(self._cache_fpath), exist_ok=True)
+            with open(tmp_fpath, "wb") as f:
+                pickle.dump(self._used, f, protocol=pickle.HIGHEST_PROTOCOL)
+            replace(tmp_fpath, self._cache_fpath)
+        except OSError as e:
+            logging.warning(f"could not save the reply cache {self._cache_fpath}: {e}")
+
+
 class Project:
     def __init__(self, project_codemodel, codemodel):
         self._project_codemodel = project_codemodel
         self._codemodel = codemodel
         self._graph = None
         self._project_node = None
+        self._target_indexes_set = None
 
     def name(self):
         return self._project_codemodel["name"]
@@ -29,62 +98,66 @@ class Project:
     def directory_indexes(self):
         return self._project_codemodel["directoryIndexes"]
 
+    def target_indexes_set(self):
+        if self._target_indexes_set is None:
+            self._target_indexes_set = frozenset(self.target_indexes())
+        return self._target_indexes_set
+
     def full_dependence(self, target):
-        deps = target.dependency_indexes()
-        return all(ind in deps for ind in self.target_indexes())
+        return self.target_indexes_set().issubset(target.dependency_indexes_set())
 
     def get_project_node(self):
-        if self._graph is None:
-            self._graph = self.get_graph()
-        assert self._project_node is not None
+        if self._project_node is not None:
+            return self._project_node
+
+        # add a dummy invisible node per cluster
+        # in the case we need an edge pointing at the whole project
+        # like when all targets of the project are used
+        pr_graph = self.get_graph()
+        project_node = dot.Node(
+            f"PROJNODE_{pr_graph.get_name()}",
+            label=self.name(),
+            shape="point",
+            style="invis",
+        )
+        pr_graph.add_node(project_node)
+        self._project_node = project_node
         return self._project_node
 
-    def get_graph(self, layout="dot", bgcolor="white", style="dotted"):
+    def get_graph(self, layout="dot", bgcolor="white", style="dotted", tooltip=True):
         if self._graph is not None:
             return self._graph
 
         pr_name = self.name()
-        dir_sources = []
-        for i in self.directory_indexes():
-            dir_sources.append(self._codemodel["directories"][i]["source"])
+        dir_sources = None
+        if tooltip:
+            dir_sources = "\n".join(
+                self._codemodel["directories"][i]["source"]
+                for i in self.directory_indexes()
+            )
 
-        pr_graph = pydot.Cluster(
+        pr_graph = dot.Cluster(
             # f"cluster_{pr_name}",
             pr_name,
             label=pr_name,
-            tooltip="\n".join(dir_sources),
+            tooltip=dir_sources,
             bgcolor=bgcolor,
             layout=layout,
             style=style,
         )
         pr_graph.set("class", "project")
 
-        # add a dummy invisible node per cluster
-        # in the case we need an edge pointing at the whole project
-        # like when all targets of the project are used
-        project_node = pydot.Node(
-            f"PROJNODE_{pr_graph.get_name()}",
-            label=self.name(),
-            shape="point",
-            style="invis",
-        )
-        pr_graph.add_node(project_node)
-        self._project_node = project_node
-
         self._graph = pr_graph
         return self._graph
 
 
 class Directory:
-    def __init__(self, directory_codemodel, codemodel, reply_dir):
+    def __init__(self, directory_json, directory_codemodel, codemodel):
+        self._json = directory_json
         self._directory_codemodel = directory_codemodel
         self._codemodel = codemodel
         self._graph = None
-
-        json_fpath = join(reply_dir, directory_codemodel["jsonFile"])
-        assert isfile(json_fpath)
-        with open(json_fpath, "r") as f:
-            self._json = json.load(f)
+        self._target_indexes_set = None
 
     def source(self):
         return self._directory_codemodel["source"]
@@ -98,22 +171,27 @@ class Directory:
     def project_index(self):
         return self._directory_codemodel["projectIndex"]
 
+    def target_indexes_set(self):
+        if self._target_indexes_set is None:
+            self._target_indexes_set = frozenset(self.target_indexes())
+        return self._target_indexes_set
+
     def full_dependence(self, target):
-        deps = target.dependency_indexes()
-        return all(ind in deps for ind in self.target_indexes())
+        return self.target_indexes_set().issubset(target.dependency_indexes_set())
 
-    def get_graph(self, layout="dot"):
+    def get_graph(self, layout="dot", label=True, bgcolor=None):
         if self._graph is not None:
             return self._graph
 
         dir_source = self.source()
-        dir_graph = pydot.Cluster(
+        dir_graph = dot.Cluster(
             dir_source,
-            label=f"📁 {dir_source}",
+            label=f"📁 {dir_source}" if label else None,
             labeljust="l",
             layout=layout,
             style="dotted",
             penwidth=0,
+            bgcolor=bgcolor,
         )
         dir_graph.set("class", "directory")
 
@@ -122,21 +200,32 @@ class Directory:
 
 
 class Target:
-    def __init__(self, target_codemodel, codemodel, reply_dir):
-        json_fpath = join(reply_dir, target_codemodel["jsonFile"])
-        assert isfile(json_fpath)
-        with open(json_fpath, "r") as f:
-            self._json = json.load(f)
-
+    def __init__(
+        self, target_json, target_codemodel, codemodel, id_to_index, target_defs
+    ):
+        self._json = target_json
         self._target_codemodel = target_codemodel
         self._codemodel = codemodel
+        self._id_to_index = id_to_index
+        self._target_defs = target_defs
+        # the fields read for every dependency and edge
+        self._name = target_json["name"]
+        self._type = target_json["type"]
+        self._project_index = target_codemodel["projectIndex"]
+        self._directory_index = target_codemodel["directoryIndex"]
+        self._sources = None
+        self._compile_groups = None
+        self._install_paths = None
+        self._dependency_ids = None
+        self._dependency_indexes = None
+        self._dependency_indexes_set = None
         self.project = codemodel["projects"][self.project_index()]
         self.directory = codemodel["directories"][self.directory_index()]
         self._label = self.target_name()
         self._graph = None
         self._marker = None
         self._usage_count = 0
-        self._dep_markers = []
+        self._dep_markers_joined = ""
 
     def set_label(self, label):
         self._label = label
@@ -144,15 +233,18 @@ class Target:
         if self._graph is None:
             return
 
-        if self._dep_markers:
-            graph_label = label + "\n" + " ".join(self._dep_markers)
+        if self._dep_markers_joined:
+            graph_label = f"{label}\n{self._dep_markers_joined}"
         else:
             graph_label = label
 
         self._graph.set_label(graph_label)
 
     def add_dep_marker(self, dep_mark):
-        self._dep_markers.append(dep_mark)
+        if self._dep_markers_joined:
+            self._dep_markers_joined = f"{self._dep_markers_joined} {dep_mark}"
+        else:
+            self._dep_markers_joined = dep_mark
         self.set_label(self._label)
 
     def set_marker(self, marker, usage_count):
@@ -164,56 +256,82 @@ class Target:
         return self._marker
 
     def type(self):
-        return self._json["type"]
+        return self._type
 
     def sources(self):
-        return [src["path"] for src in self._json.get("sources", [])]
+        if self._sources is None:
+            # the same paths show up in many targets of a project,
+            # keep one copy of each string
+            self._sources = [
+                sys.intern(src["path"]) for src in self._json.get("sources", [])
+            ]
+        return self._sources
 
     def compile_groups(self):
+        if self._compile_groups is not None:
+            return self._compile_groups
+
         cmp_info = []
         sources = self.sources()
         for cmp in self._json.get("compileGroups", []):
             info = {
                 "sources": [sources[i] for i in cmp["sourceIndexes"]],
-                "includes": [i["path"] for i in cmp.get("includes", [])],
+                "includes": [sys.intern(i["path"]) for i in cmp.get("includes", [])],
                 "defines": [i["define"] for i in cmp.get("defines", [])],
             }
             cmp_info.append(info)
-        return cmp_info
+        self._compile_groups = cmp_info
+        return self._compile_groups
 
     def cmake_lists(self):
         return self._json["backtraceGraph"]["files"]
 
     def dependency_ids(self):
-        return [dep["id"] for dep in self._json.get("dependencies", [])]
+        if self._dependency_ids is None:
+            self._dependency_ids = tuple(
+                dep["id"] for dep in self._json.get("dependencies", [])
+            )
+        return self._dependency_ids
 
     def dependency_indexes(self):
-        inds = []
-        dep_ids = self.dependency_ids()
-        for i, t_model in enumerate(self._codemodel["targets"]):
-            if t_model["id"] in dep_ids:
-                inds.append(i)
-        return inds
+        if self._dependency_indexes is None:
+            # keep the order of the codemodel targets list
+            self._dependency_indexes = sorted(
+                self._id_to_index[dep_id] for dep_id in self.dependency_ids()
+            )
+        return self._dependency_indexes
+
+    def dependency_indexes_set(self):
+        if self._dependency_indexes_set is None:
+            self._dependency_indexes_set = frozenset(self.dependency_indexes())
+        return self._dependency_indexes_set
 
     def target_id(self):
         return self._json["id"]
 
     def target_name(self):
-        return self._json["name"]
+        return self._name
 
     def project_index(self):
-        return self._target_codemodel["projectIndex"]
+        return self._project_index
 
     def directory_index(self):
-        return self._target_codemodel["directoryIndex"]
+        return self._directory_index
 
     def target_install_paths(self):
+        if self._install_paths is not None:
+            return self._install_paths
+
         install = self._json.get("install")
         if install is None:
-            return None
+            # not installed
+            self._install_paths = []
+            return self._install_paths
+
         prefix = install["prefix"]["path"]
-        destinations = [d for d in install["destinations"]]
-        return [join(prefix, d["path"]) for d in destinations]
+        destinations = install["destinations"]
+        self._install_paths = [join(prefix, d["path"]) for d in destinations]
+        return self._install_paths
 
     def find_cmake_define(self):
         bg = self._json["backtraceGraph"]
@@ -236,16 +354,9 @@ class Target:
 
         return def_com, def_file, def_line
 
-    def get_graph(self):
-        if self._graph is not None:
-            return self._graph
-
-        t_name = self.target_name()
-        t_type = self.type()
-
-        # create the node and dependencies
+    def get_tooltip(self, max_sources=None):
         extra_info = []
-        extra_info.append(f"type={t_type}")
+        extra_info.append(f"type={self.type()}")
 
         definition = self.find_cmake_define()
         if definition:
@@ -253,28 +364,46 @@ class Target:
             extra_info.append(f"{com} @ {fname}:{line}")
 
         extra_info.append(f"len(depends)={len(self.dependency_ids())}")
-        dep_defs = []
-        for dep_ind in self.dependency_indexes():
-            dep_model = self._codemodel["targets"][dep_ind]
-            dep_proj_ind = dep_model["projectIndex"]
-            dep_proj_name = self._codemodel["projects"][dep_proj_ind]["name"]
-            dep_defs.append(f"{dep_proj_name}: {dep_model["name"]}")
-        extra_info.append("\n".join(["deps:"] + sorted(dep_defs)))
+        dep_defs = [self._target_defs[i] for i in self.dependency_indexes()]
+        extra_info.append("deps:")
+        extra_info.extend(sorted(dep_defs))
 
         installs = self.target_install_paths()
         if installs:
-            extra_info.append(f"installs:\n{'\n'.join(installs)}")
+            extra_info.append("installs:")
+            extra_info.extend(installs)
 
+        # all lines go into one list, joined once at the end
         compile_groups = self.compile_groups()
         if compile_groups:
             extra_info.append("compile_groups:")
         for cmp in compile_groups:
-            extra_info.append("\n".join(["includes:"] + cmp["includes"]))
-            extra_info.append("\n".join(["defines:"] + cmp["defines"]))
-            extra_info.append("\n".join(["sources:"] + cmp["sources"]))
+            sources = cmp["sources"]
+            extra_info.append("includes:")
+            extra_info.extend(cmp["includes"])
+            extra_info.append("defines:")
+            extra_info.extend(cmp["defines"])
+            extra_info.append("sources:")
+            if max_sources is not None and len(sources) > max_sources:
+                extra_info.extend(sources[:max_sources])
+                extra_info.append(f"... {len(sources) - max_sources} more")
+            else:
+                extra_info.extend(sources)
+
+        return "\n".join(extra_info)
+
+    def get_graph(self, build_tooltip=True, max_tooltip_sources=None, shape=None):
+        if self._graph is not None:
+            return self._graph
 
-        target_node = pydot.Node(
-            t_name, label=self._label, tooltip="\n".join(extra_info)
+        # the tooltip is only seen in the interactive SVG
+        # and can be huge for targets with many sources
+        tooltip = None
+        if build_tooltip:
+            tooltip = self.get_tooltip(max_tooltip_sources)
+
+        target_node = dot.Node(
+            self.target_name(), label=self._label, tooltip=tooltip, shape=shape
         )
         target_node.set("class", "node")
 
@@ -284,10 +413,21 @@ class Target:
 
 
 class Codemodel:
-    def __init__(self, codemodel_dir, cfg, perproject=True):
+    def __init__(
+        self,
+        codemodel_dir,
+        cfg,
+        perproject=True,
+        simple_threshold=SIMPLE_THRESHOLD_DEFAULT,
+        json_loader=load_json,
+    ):
         self.name = cfg["name"]
 
-        self.root_graph = pydot.Dot(
+        # large graphs are drawn without the details
+        # that make the graphviz layout and the SVG heavy
+        self.simple = len(cfg["targets"]) > simple_threshold
+
+        self.root_graph = dot.Dot(
             f"targetgraph-{self.name}",
             graph_type="digraph",
             bgcolor="white",
@@ -298,56 +438,89 @@ class Codemodel:
         for pr in cfg["projects"]:
             self.projects.append(Project(pr, cfg))
 
+        # the directory and target reply files are independent,
+        # read them all concurrently
+        dir_fpaths = [join(codemodel_dir, d["jsonFile"]) for d in cfg["directories"]]
+        target_fpaths = [join(codemodel_dir, t["jsonFile"]) for t in cfg["targets"]]
+        with ThreadPoolExecutor() as executor:
+            dir_jsons = executor.map(json_loader, dir_fpaths)
+            target_jsons = executor.map(json_loader, target_fpaths)
+
         self.directories = []
-        for dir_model in cfg["directories"]:
-            directory = Directory(dir_model, cfg, codemodel_dir)
+        for dir_json, dir_model in zip(dir_jsons, cfg["directories"]):
+            directory = Directory(dir_json, dir_model, cfg)
             self.directories.append(directory)
 
+        # map target ids to their indexes in the codemodel targets list
+        self.id_to_index = {t["id"]: i for i, t in enumerate(cfg["targets"])}
+
+        # "project: target" of every target, for the dependency tooltips
+        projects = cfg["projects"]
+        self.target_defs = [
+            f"{projects[t['projectIndex']]['name']}: {t['name']}"
+            for t in cfg["targets"]
+        ]
+
         self.targets = []
-        for t_model in cfg["targets"]:
+        for target_json, t_model in zip(target_jsons, cfg["targets"]):
             target = Target(
+                target_json=target_json,
                 target_codemodel=t_model,
                 codemodel=cfg,
-                reply_dir=codemodel_dir,
+                id_to_index=self.id_to_index,
+                target_defs=self.target_defs,
             )
             self.targets.append(target)
 
+        # the project of each target
+        # (the targets of a project are in Project.target_indexes)
+        self.target_to_proj = [t.project_index() for t in self.targets]
+
+        # make the project clusters once, the dependencies refer to them
+        self.project_graphs = [
+            proj.get_graph(tooltip=not self.simple) for proj in self.projects
+        ]
+
         # collect target-target dependencies
         self.dependencies = []
-        for target in self.targets:
-            project = self.projects[target.project_index()]
+        for t_ind, target in enumerate(self.targets):
+            t_proj_ind = self.target_to_proj[t_ind]
 
-            full_project_dependencies = set()
+            # the check is the same for all dependencies in a project
+            full_dep_per_project = {}
             for dep_ind in target.dependency_indexes():
                 # if dependencies include all targets of a project
                 # then depend on the whole project
                 # - add lhead=cluester name
                 dep_target = self.targets[dep_ind]
-                dep_proj = self.projects[dep_target.project_index()]
-                dep_proj_id = dep_proj.get_graph().get_name()
+                dep_proj_ind = self.target_to_proj[dep_ind]
+                dep_proj = self.projects[dep_proj_ind]
 
-                full_dep = dep_proj.full_dependence(target)
+                full_dep = full_dep_per_project.get(dep_proj_ind)
+                if full_dep is None:
+                    full_dep = dep_proj.full_dependence(target)
+                    full_dep_per_project[dep_proj_ind] = full_dep
 
-                edge_style = (
-                    "invis" if dep_proj_id in full_project_dependencies else "dashed"
-                )
+                # the per-dependency messages are formatted lazily,
+                # only when the debug level is on
                 logging.debug(
-                    f"check full deps: {target.target_name()} {dep_proj_id} in {full_project_dependencies}"
+                    "check full deps: %s %s: %s",
+                    target.target_name(),
+                    dep_proj_ind,
+                    full_dep,
                 )
 
                 dep_name = dep_target.target_name()
-                if (
-                    perproject
-                    and full_dep
-                    and target.project_index() != dep_target.project_index()
-                ):
-                    dep_name = dep_proj.get_project_node().get_name()
+                if perproject and full_dep and t_proj_ind != dep_proj_ind:
+                    # only for the debug message, the project node
+                    # is made where the edge to it is drawn
+                    dep_name = f"project {dep_proj.name()}"
                     # dep_proj_name = dep_proj.get_project_node().get_label()
                     # edge_tooltip = f"all targets from\n{dep_proj_name}"
 
-                if target.project_index() == dep_target.project_index():
+                if t_proj_ind == dep_proj_ind:
                     # project.get_graph().add_edge(dep_edge)
-                    graph_for_edge = project.get_graph()
+                    graph_for_edge = self.project_graphs[t_proj_ind]
                 else:
                     # graph.add_edge(dep_edge)
                     graph_for_edge = self.root_graph
@@ -361,7 +534,11 @@ class Codemodel:
                 self.dependencies.append(dep)
 
                 logging.debug(
-                    f"Added node dep: {target.target_name()} {dep_name} : {target.dependency_indexes()} - {dep_proj.target_indexes()}"
+                    "Added node dep: %s %s : %s - %s",
+                    target.target_name(),
+                    dep_name,
+                    target.dependency_indexes(),
+                    dep_proj.target_indexes(),
                 )
 
         pass
@@ -0,0 +1,186 @@
+"""
+A minimal DOT graph model: the part of pydot that cmake_graph uses.
+
+The graph objects only keep their names and attributes,
+and the whole graph is written out as DOT text in one pass.
+The SVG is rendered by graphviz from the written DOT file.
+
+The quoting is checked with: python -m doctest src/cmake_graph/dot.py
+"""
+
+from io import StringIO
+
+_ESCAPES = str.maketrans({'"': r"\"", "\\": r"\\", "\n": r"\n"})
+
+
+def quote(value):
+    r"""
+    Every ID is written as a quoted string,
+    so the names that are DOT keywords are safe too.
+
+    >>> print(quote('a "b" c\\d\ne'))
+    "a \"b\" c\\d\ne"
+    >>> print(quote("node"), quote("graph"), quote(True))
+    "node" "graph" "true"
+
+    The DOT unescaping gives back the original text:
+
+    >>> import re
+    >>> text = 'a "b" c\\d\ne'
+    >>> unescape = {"n": "\n", '"': '"', "\\": "\\"}
+    >>> re.sub(r"\\(.)", lambda m: unescape[m[1]], quote(text)[1:-1]) == text
+    True
+
+    >>> g = Dot("graph")
+    >>> g.add_node(Node("node", label='a "b"\n'))
+    >>> print(g.to_string(), end="")
+    digraph "graph" {
+        "node" [label="a \"b\"\n"];
+    }
+    """
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+    return f'"{str(value).translate(_ESCAPES)}"'
+
+
+def attr_list(attrs):
+    items = [
+        f"{attr}={quote(value)}" for attr, value in attrs.items() if value is not None
+    ]
+    if not items:
+        return ""
+    return f" [{', '.join(items)}]"
+
+
+class Node:
+    # there is one object per target and per edge, keep them small
+    __slots__ = ("_name", "_attrs")
+
+    def __init__(self, name, **attrs):
+        self._name = name
+        self._attrs = attrs
+
+    def get_name(self):
+        return self._name
+
+    def get(self, attr):
+        return self._attrs.get(attr)
+
+    def set(self, attr, value):
+        self._attrs[attr] = value
+
+    def get_label(self):
+        return self.get("label")
+
+    def set_label(self, label):
+        self.set("label", label)
+
+    def _write(self, out, indent, edge_op):
+        out.write(f"{indent}{quote(self._name)}{attr_list(self._attrs)};\n")
+
+
+class Edge:
+    __slots__ = ("_source", "_destination", "_attrs")
+
+    def __init__(self, source, destination, **attrs):
+        self._source = source
+        self._destination = destination
+        self._attrs = attrs
+
+    def get_source(self):
+        return self._source
+
+    def get_destination(self):
+        return self._destination
+
+    def set(self, attr, value):
+        self._attrs[attr] = value
+
+    def _write(self, out, indent, edge_op):
+        out.write(
+            f"{indent}{quote(self._source)} {edge_op} {quote(self._destination)}"
+            f"{attr_list(self._attrs)};\n"
+        )
+
+
+class Graph:
+    keyword = "subgraph"
+
+    def __init__(self, name, **attrs):
+        self._name = name
+        self._attrs = attrs
+        # nodes, subgraphs and edges in the order they are added
+        self._body = []
+
+    def get_name(self):
+        return self._name
+
+    def get(self, attr):
+        return self._attrs.get(attr)
+
+    def set(self, attr, value):
+        self._attrs[attr] = value
+
+    def set_label(self, label):
+        self.set("label", label)
+
+    def add_node(self, node):
+        self._body.append(node)
+
+    def add_subgraph(self, subgraph):
+        self._body.append(subgraph)
+
+    def add_edge(self, edge):
+        self._body.append(edge)
+
+    def _write(self, out, indent, edge_op):
+        out.write(f"{indent}{self.keyword} {quote(self._name)} {{\n")
+        body_indent = indent + "    "
+        for attr, value in self._attrs.items():
+            if value is not None:
+                out.write(f"{body_indent}{attr}={quote(value)};\n")
+        for obj in self._body:
+            obj._write(out, body_indent, edge_op)
+        out.write(f"{indent}}}\n")
+
+
+class Cluster(Graph):
+    def __init__(self, name, **attrs):
+        super().__init__(f"cluster_{name}", **attrs)
+
+
+class Dot(Graph):
+    def __init__(self, name, graph_type="digraph", **attrs):
+        super().__init__(name, **attrs)
+        self.keyword = graph_type
+
+    def write(self, out):
+        edge_op = "->" if self.keyword == "digraph" else "--"
+        self._write(out, "", edge_op)
+
+    def to_string(self):
+        out = StringIO()
+        self.write(out)
+        return out.getvalue()
+
+    def write_raw(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            self.write(f)
+
+
+def render_svg(dot_fpath, prog="dot"):
+    # subprocess is only needed to render, not for the setup command
+    import subprocess
+
+    # graphviz errors and warnings go straight to the terminal
+    try:
+        result = subprocess.run(
+            [prog, "-Tsvg", dot_fpath],
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+    except FileNotFoundError as e:
+        raise RuntimeError(
+            f"graphviz executable {prog!r} not found, is graphviz installed?"
+        ) from e
+    return result.stdout
@@ -2,59 +2,61 @@
 Let's check how pydot works.
 """
 
-import json
+import hashlib
 import logging
-from glob import glob
-from os.path import isfile, isdir, join, getctime
-import pydot
-from collections import defaultdict
+from os import makedirs, scandir
+from os.path import abspath, expanduser, isfile, isdir, join
+from cmake_graph import dot
+from concurrent.futures import ThreadPoolExecutor
 import re
+from collections import Counter
 from itertools import chain
 
-from cmake_graph.codemodel import Codemodel
+from cmake_graph.codemodel import (
+    SIMPLE_THRESHOLD_DEFAULT,
+    Codemodel,
+    ReplyCache,
+    load_json,
+)
 
 logging.basicConfig(level=logging.INFO)
 
 CMAKE_API_CLIENT_NAME = "targetgraph"
 CMAKE_API_PATH = ".cmake/api/v1/"
+CACHE_DIR = join(expanduser("~"), ".cache", "cmake_graph")
 GRAPHVIZ_LAYOUT_DEFAULT = "dot"
 GRAPHVIZ_COLOR_FOR_DIRECTORY = "#fcd5ce"
+GRAPHVIZ_FAST_NSLIMIT = 5
 
-node_shapes = defaultdict(lambda: "septagon")
-node_shapes.update(
-    {
-        "EXECUTABLE": "egg",
-        "STATIC_LIBRARY": "octagon",
-        "INTERFACE_LIBRARY": "pentagon",
-        "SHARED_LIBRARY": "doubleoctagon",
-        "OBJECT_LIBRARY": "hexagon",
-        "MODULE_LIBRARY": "tripleoctagon",
-        "UTILITY": "note",
-    }
-)
+NODE_SHAPE_DEFAULT = "septagon"
+NODE_SHAPES = {
+    "EXECUTABLE": "egg",
+    "STATIC_LIBRARY": "octagon",
+    "INTERFACE_LIBRARY": "pentagon",
+    "SHARED_LIBRARY": "doubleoctagon",
+    "OBJECT_LIBRARY": "hexagon",
+    "MODULE_LIBRARY": "tripleoctagon",
+    "UTILITY": "note",
+}
 
 
 class GenerateLetters:
     # greek_codes   = chain(range(0x370, 0x3e2), range(0x3f0, 0x400))
     greek_codes = chain(range(0x3B1, 0x3CA), range(0x391, 0x3AA))
     greek_symbols = (chr(c) for c in greek_codes)
-    greek_letters = [c for c in greek_symbols if c.isalpha()]
+    greek_letters = tuple(c for c in greek_symbols if c.isalpha())
 
     def __init__(self):
-        self._index = 0
+        self._letters = iter(self.greek_letters)
 
     def next(self):
-        if self._index > len(self.greek_letters):
+        try:
+            return next(self._letters)
+        except StopIteration:
             raise RuntimeError("ran out of letters!")
 
-        letter = self.greek_letters[self._index]
-        self._index += 1
-        return letter
-
 
 def cmake_api_setup_query(build_dir: str):
-    from os import makedirs
-
     api_dir = join(build_dir, CMAKE_API_PATH)
     makedirs(api_dir, exist_ok=True)
     api_dir_query = join(api_dir, "query", f"client-{CMAKE_API_CLIENT_NAME}")
@@ -70,11 +72,16 @@ def cmake_api_get_reply_dir(build_dir: str):
     return api_dir_reply
 
 
-def cmake_api_configs(codemodel_fname: str):
-    assert isfile(codemodel_fname)
-    with open(codemodel_fname, "r") as f:
-        codemodel = json.load(f)
+def cmake_api_codemodel_file(index_file: str, json_loader=load_json):
+    # only one entry of the index is needed,
+    # do not keep the whole index around while the graphs are built
+    index = json_loader(index_file)
+    my_reply = index["reply"][f"client-{CMAKE_API_CLIENT_NAME}"]
+    return my_reply["codemodel-v2"]["jsonFile"]
+
 
+def cmake_api_configs(codemodel_fname: str, json_loader=load_json):
+    codemodel = json_loader(codemodel_fname)
     return codemodel["configurations"]
 
 
@@ -95,53 +102,77 @@ def cmake_build_config_graph(
     perproject=True,
     frequent_deps_threshold=5,
     rankdir="LR",
+    tooltips=True,
+    max_tooltip_sources=None,
+    simple_threshold=SIMPLE_THRESHOLD_DEFAULT,
+    fast_layout=False,
+    json_loader=load_json,
 ):
-    codemodel = Codemodel(reply_dir, cfg, perproject)
+    codemodel = Codemodel(reply_dir, cfg, perproject, simple_threshold, json_loader)
+    simple = codemodel.simple
+    if simple:
+        logging.info(
+            f"{len(codemodel.targets)} targets, drawing a simplified graph: "
+            "no tooltips, no directory labels, solid edges"
+        )
+        tooltips = False
 
     root_graph = codemodel.root_graph
-    root_graph.set_layout(layout)
-    root_graph.set_rankdir(rankdir)
+    root_graph.set("layout", layout)
+    root_graph.set("rankdir", rankdir)
+    if fast_layout:
+        # bound the network simplex iterations of the dot layout
+        root_graph.set("nslimit", GRAPHVIZ_FAST_NSLIMIT)
+        root_graph.set("nslimit1", GRAPHVIZ_FAST_NSLIMIT)
     root_project_cluster = None
 
     projects = codemodel.projects
+    project_graphs = codemodel.project_graphs
 
-    for proj in projects:
+    for proj, pgraph in zip(projects, project_graphs):
         parent_index = proj.parent_index()
         if parent_index is None:
-            root_project_cluster = proj.get_graph()
-            root_graph.add_subgraph(proj.get_graph())
+            root_project_cluster = pgraph
+            root_graph.add_subgraph(pgraph)
         else:
-            projects[parent_index].get_graph().add_subgraph(proj.get_graph())
+            project_graphs[parent_index].add_subgraph(pgraph)
 
     directories = codemodel.directories
+    directory_graphs = []
     for directory in directories:
-        dgraph = directory.get_graph()
-        projects[directory.project_index()].get_graph().add_subgraph(
+        dgraph = directory.get_graph(
+            label=not simple, bgcolor=GRAPHVIZ_COLOR_FOR_DIRECTORY
+        )
+        project_graphs[directory.project_index()].add_subgraph(
             dgraph
         )
-        dgraph.set_bgcolor(GRAPHVIZ_COLOR_FOR_DIRECTORY)
+        directory_graphs.append(dgraph)
 
     # TODO: check how this works?
     # I don't add a node to the directory graph
     # but won't it create and edge for this dependency later?
     # targets = []
     targets = codemodel.targets
+    skip_types_re = re.compile(skip_types) if skip_types else None
+    skip_names_re = re.compile(skip_names) if skip_names else None
     for trg in codemodel.targets:
         t_name = trg.target_name()
         t_type = trg.type()
 
-        if skip_types and re.match(skip_types, t_type):
+        if skip_types_re and skip_types_re.match(t_type):
             continue
 
-        if skip_names and re.match(skip_names, t_name):
+        if skip_names_re and skip_names_re.match(t_name):
             continue
 
         # targets.append(trg)
 
-        directory = directories[trg.directory_index()]
-        tgraph = trg.get_graph()
-        directory.get_graph().add_node(tgraph)
-        tgraph.set_shape(node_shapes[t_type])
+        tgraph = trg.get_graph(
+            build_tooltip=tooltips,
+            max_tooltip_sources=max_tooltip_sources,
+            shape=NODE_SHAPES.get(t_type, NODE_SHAPE_DEFAULT),
+        )
+        directory_graphs[trg.directory_index()].add_node(tgraph)
 
     dependencies = codemodel.dependencies
 
@@ -150,9 +181,9 @@ def cmake_build_config_graph(
     frequent_dependencies = set()
     frequent_dependencies_inds = set()
     icon_generator = GenerateLetters()
-    deps_to = [dep.to for dep in dependencies]
+    usage_counts = Counter(dep.to for dep in dependencies)
     for t_ind, target in enumerate(targets):
-        usage_count = deps_to.count(target)
+        usage_count = usage_counts[target]
         if usage_count > frequent_deps_threshold:
             frequent_dependencies.add(target)
             frequent_dependencies_inds.add(t_ind)
@@ -162,22 +193,25 @@ def cmake_build_config_graph(
 
     # count usage of sub-sets
     # of dependencies
-    subsets_count = {}
+    subsets_count = Counter()
     for target in targets:
         # target_dep_set = set(targets[i] for i in target.dependency_indexes())
-        target_dep_set = frozenset(target.dependency_indexes())
+        # the cached dependency set, only the intersection is allocated
+        target_dep_set = target.dependency_indexes_set()
         target_freq_set = target_dep_set.intersection(frequent_dependencies_inds)
         if not target_freq_set:
             continue
-        subsets_count.setdefault(target_freq_set, 0)
         subsets_count[target_freq_set] += 1
 
     # find only the largest set for now
-    used_set_indexes = max(subsets_count, key=lambda t_set: subsets_count[t_set])
-    logging.info(f"{used_set_indexes}")
-    count = subsets_count[used_set_indexes]
+    # (there is none when no target is used frequently)
+    used_set_indexes, count = frozenset(), 0
+    if subsets_count:
+        used_set_indexes, count = subsets_count.most_common(1)[0]
+        logging.info(f"{used_set_indexes}")
     used_set = set(targets[i] for i in used_set_indexes)
     used_set_node = None
+    used_set_node_name = None
     if count > frequent_deps_threshold and len(used_set) > frequent_deps_threshold:
         # create an extra node
         set_target_names = "\n".join(t.target_name() for t in used_set)
@@ -194,7 +228,7 @@ def cmake_build_config_graph(
             f"{i:2} {tm} {pn}: {tn}" for i, (pn, tn, tm) in enumerate(target_addrs)
         )
 
-        used_set_node = pydot.Node(
+        used_set_node = dot.Node(
             "max_used_set",
             label=f"set of {len(used_set)} targets that are used together by {count}",
             shape="circle",
@@ -202,6 +236,7 @@ def cmake_build_config_graph(
             tooltip=tooltip,
         )
         used_set_node.set("class", "node")
+        used_set_node_name = used_set_node.get_name()
 
         # let's just add it to the top graph
         # root_graph.add_node(used_set_node)
@@ -209,9 +244,9 @@ def cmake_build_config_graph(
 
         # add edges from the node
         for target in used_set:
-            dep_edge = pydot.Edge(
-                used_set_node.get_name(),
-                target.get_graph().get_name(),
+            dep_edge = dot.Edge(
+                used_set_node_name,
+                target.target_name(),
                 style="dotted",
                 # tooltip=edge_tooltip,
                 # lhead=lhead
@@ -226,6 +261,7 @@ def cmake_build_config_graph(
     already_covered_full_proj_deps = set()
     used_set_edges = set()
     for target, to, edge_graph, full_dep in dependencies:
+        t_name = target.target_name()
         same_dir = target.directory_index() == to.directory_index()
 
         edge_over_used_set = (
@@ -236,19 +272,16 @@ def cmake_build_config_graph(
         #    logging.info()
 
         if edge_over_used_set:
-            edge_from = target.get_graph()
-            edge_to = used_set_node
-
-            used_set_edge = (edge_from, edge_to)
-
-            if used_set_edge in used_set_edges:
+            # all these edges point at the used set node,
+            # one edge per dependant target
+            if t_name in used_set_edges:
                 continue
             else:
-                used_set_edges.add(used_set_edge)
+                used_set_edges.add(t_name)
 
-            dep_edge = pydot.Edge(
-                edge_from.get_name(),
-                edge_to.get_name(),
+            dep_edge = dot.Edge(
+                t_name,
+                used_set_node_name,
                 style="dotted",
                 # tooltip=edge_tooltip,
                 # lhead=lhead
@@ -271,24 +304,27 @@ def cmake_build_config_graph(
         # not frequent dependencies get turned into edges
 
         # check if it's a full-project dep
-        edge_style = "dashed"
-        edge_tooltip = ""
-        lhead = ""
-        dep_node_name = to.get_graph().get_name()
+        edge_style = None if simple else "dashed"
+        # unset attributes are left out of the DOT output
+        edge_tooltip = None
+        lhead = None
+        dep_node_name = to.target_name()
         if full_dep:
-            dep_proj_name = projects[to.project_index()].name()
-            lhead = projects[to.project_index()].get_graph().get_name()
-            edge_tooltip = f"all targets from\n{dep_proj_name}"
             dep_proj_ind = to.project_index()
-            dep_node_name = projects[dep_proj_ind].get_project_node()
-
+            dep_proj = projects[dep_proj_ind]
+            lhead = project_graphs[dep_proj_ind].get_name()
+            if not simple:
+                edge_tooltip = f"all targets from\n{dep_proj.name()}"
+            dep_node_name = dep_proj.get_project_node().get_name()
+
+            # all dependencies on the project collapse into the same edge
+            # to the project node, emit it only once
             if (target, dep_proj_ind) in already_covered_full_proj_deps:
-                edge_style = "invis"
-            else:
-                already_covered_full_proj_deps.add((target, dep_proj_ind))
+                continue
+            already_covered_full_proj_deps.add((target, dep_proj_ind))
 
-        dep_edge = pydot.Edge(
-            target.target_name(),
+        dep_edge = dot.Edge(
+            t_name,
             dep_node_name,
             style=edge_style,
             tooltip=edge_tooltip,
@@ -300,37 +336,78 @@ def cmake_build_config_graph(
     return root_graph
 
 
-def cmake_api_process_reply(reply_dir: str, **kwargs):
-    """cmake_api_process_reply(reply_dir: str)
+def cmake_api_reply_cache_file(reply_dir: str):
+    reply_key = hashlib.sha1(abspath(reply_dir).encode("utf-8")).hexdigest()
+    return join(CACHE_DIR, f"reply-{reply_key}.pickle")
+
+
+def cmake_api_process_reply(reply_dir: str, cache=False, **kwargs):
+    """cmake_api_process_reply(reply_dir: str, cache=False)
 
     return graphs for all configurations returned by the codemodel-v2
-    """
 
-    # find the latest index
-    paths = glob(join(reply_dir, "index*"))
-    files = [p for p in paths if isfile(p)]
-    index_file = max(files, key=getctime)
+    with cache=True the parsed reply files are kept between the runs
+    """
 
-    with open(index_file, "r") as f:
-        index = json.load(f)
+    reply_cache = None
+    json_loader = load_json
+    if cache:
+        reply_cache = ReplyCache(cmake_api_reply_cache_file(reply_dir))
+        json_loader = reply_cache.load_json
 
-    my_reply = index["reply"][f"client-{CMAKE_API_CLIENT_NAME}"]
-    codemodel_fname = my_reply["codemodel-v2"]["jsonFile"]
+    # find the latest index
+    # DirEntry caches the file type and stat info of the directory scan
+    with scandir(reply_dir) as entries:
+        index_file = max(
+            (e for e in entries if e.name.startswith("index") and e.is_file()),
+            key=lambda e: e.stat().st_ctime,
+        ).path
+
+    codemodel_fname = cmake_api_codemodel_file(index_file, json_loader)
     full_fpath = join(reply_dir, codemodel_fname)
-    assert isfile(full_fpath), f"not a file: {full_fpath}"
 
     # return target graphs for each config
     all_graphs = []
-    for cfg in cmake_api_configs(full_fpath):
-        graph = cmake_build_config_graph(cfg, reply_dir, **kwargs)
+    for cfg in cmake_api_configs(full_fpath, json_loader):
+        graph = cmake_build_config_graph(
+            cfg, reply_dir, json_loader=json_loader, **kwargs
+        )
         all_graphs.append(graph)
 
+    if reply_cache is not None:
+        reply_cache.save()
+
     return all_graphs
 
 
+def render_graph(graph, stylesheet=None):
+    dot_fpath = f"{graph.get_name()}.dot"
+    graph.write_raw(dot_fpath)
+
+    # graph.write_svg(f"{graph.get_name()}.svg")
+    # graphviz reads the DOT file that is already written,
+    # the graph is not serialized twice
+    # keep the SVG as the UTF-8 bytes from graphviz
+    svg_bytes = dot.render_svg(dot_fpath)
+    # insert the style
+    if stylesheet is not None:
+        svg_tag_start = svg_bytes.index(b"<svg")
+        svg_tag_end = svg_bytes.index(b">", svg_tag_start) + 1
+        svg_bytes = svg_bytes[:svg_tag_end] + stylesheet + svg_bytes[svg_tag_end:]
+
+    with open(f"{graph.get_name()}.svg", "wb") as f:
+        f.write(svg_bytes)
+
+
 def cmake_graph_cli():
     import argparse
 
+    def non_negative_int(value):
+        number = int(value)
+        if number < 0:
+            raise argparse.ArgumentTypeError(f"{value} is negative")
+        return number
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="Graph CMake targets using file-api",
@@ -390,6 +467,40 @@ def cmake_graph_cli():
         help=f"don't merge per-project edges",
     )
 
+    parser.add_argument(
+        "--no-tooltips",
+        action="store_true",
+        help=f"don't add the target info tooltips to the nodes",
+    )
+
+    parser.add_argument(
+        "--max-tooltip-sources",
+        type=non_negative_int,
+        default=None,
+        help=f"list at most this many sources per compile group in the tooltips",
+    )
+
+    parser.add_argument(
+        "--simple-threshold",
+        type=int,
+        default=SIMPLE_THRESHOLD_DEFAULT,
+        help=f"draw a simplified graph when there are more targets than this "
+        f"({SIMPLE_THRESHOLD_DEFAULT})",
+    )
+
+    parser.add_argument(
+        "--fast-layout",
+        action="store_true",
+        help=f"limit the dot layout iterations (nslimit, nslimit1): "
+        "much faster on dense graphs, but the layout is less tidy",
+    )
+
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"keep the parsed reply files in {CACHE_DIR} between the runs",
+    )
+
     parser.add_argument(
         "--stylesheet",
         type=str,
@@ -418,30 +529,23 @@ def cmake_graph_cli():
         perproject=not args.no_perproject,
         frequent_deps_threshold=args.frequent_deps_threshold,
         rankdir=args.rankdir,
+        tooltips=not args.no_tooltips,
+        max_tooltip_sources=args.max_tooltip_sources,
+        simple_threshold=args.simple_threshold,
+        fast_layout=args.fast_layout,
+        cache=args.cache,
     )
 
     stylesheet = None
     if isfile(args.stylesheet):
         with open(args.stylesheet, "r") as f:
-            stylesheet = f"<style>\n{f.read()}\n</style>"
+            stylesheet = f"<style>\n{f.read()}\n</style>".encode("utf-8")
     else:
         logging.warn(f"did not find the stylesheet file {args.stylesheet}")
 
-    for graph in all_cfg_graphs:
-        graph.write_raw(f"{graph.get_name()}.dot")
-
-        # graph.write_svg(f"{graph.get_name()}.svg")
-        svg_text = graph.create_svg().decode("utf-8")
-        # insert the style
-        if stylesheet is not None:
-            svg_tag_start = svg_text.find("<svg")
-            svg_tag_end = svg_tag_start + svg_text[svg_tag_start:].find(">")
-            svg_text = (
-                svg_text[: svg_tag_end + 1] + stylesheet + svg_text[svg_tag_end + 1 :]
-            )
-
-        with open(f"{graph.get_name()}.svg", "w") as f:
-            f.write(svg_text)
+    # graphviz runs in a subprocess per graph, render them in parallel
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(lambda g: render_graph(g, stylesheet), all_cfg_graphs))
 
 
 if __name__ == "__main__":